@@ -1,7 +1,8 @@
-import copy
 import os
+import urllib.request
 from abc import ABC
-from typing import List
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from typing import List, Optional
 
 import duckietown_code_utils as dtu
 from duckietown_code_utils.cli import D8App
@@ -92,7 +93,6 @@ def download_if_necessary(log: PhysicalLog) -> PhysicalLog:
 
 def get_log_if_not_exists(log: PhysicalLog, resource_name: str) -> str:
     """ " Returns the path to the log."""
-    log = copy.deepcopy(log)
     dtu.logger.info(f"Get log if not exists: {log.log_name}")
     downloads = dtu.get_duckietown_local_log_downloads()
 
@@ -130,6 +130,13 @@ def get_log_if_not_exists(log: PhysicalLog, resource_name: str) -> str:
 
     use.sort(key=priority)
 
+    # Try first the server that answers first, then the others by priority
+    if len(use) > 1:
+        fastest = _get_fastest_url(use)
+        if fastest is not None:
+            use.remove(fastest)
+            use.insert(0, fastest)
+
     for url in use:
         try:
             dtu.d8n_make_sure_dir_exists(filename)
@@ -145,3 +152,29 @@ def get_log_if_not_exists(log: PhysicalLog, resource_name: str) -> str:
     # invalidate cache
     invalidate_log_cache_because_downloaded()
     return filename
+
+
+def _get_fastest_url(urls: List[str], timeout: float = 2.0) -> Optional[str]:
+    """
+    Sends a HEAD request to all the URLs concurrently and returns the first one that answers
+    successfully, or None if none does.
+    """
+
+    def probe(url: str) -> str:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=timeout):
+            pass
+        return url
+
+    executor = ThreadPoolExecutor(max_workers=len(urls))
+    try:
+        futures = [executor.submit(probe, url) for url in urls]
+        for future in as_completed(futures):
+            try:
+                return future.result()
+            except Exception as e:  # XXX
+                dtu.logger.debug(f"HEAD request failed: {e}")
+        return None
+    finally:
+        # do not wait for the slower servers
+        executor.shutdown(wait=False)
@@ -1,3 +1,4 @@
+import functools
 import os
 from collections import defaultdict, namedtuple
 from dataclasses import replace
@@ -30,10 +31,12 @@ def get_easy_logs_db2(do_not_use_cloud: bool, do_not_use_local: bool, ignore_cac
 
 
 def invalidate_log_cache_because_downloaded():
+    get_all_resources.cache_clear()
     dtu.get_cached(EasyLogsConstants.CACHE_LOCAL, lambda: None, just_delete=True)
 
 
 def delete_easy_logs_cache():
+    get_all_resources.cache_clear()
     dtu.get_cached(EasyLogsConstants.CACHE_LOCAL, lambda: None, just_delete=True)
     dtu.get_cached(EasyLogsConstants.CACHE_CLOUD, lambda: None, just_delete=True)
 
@@ -241,7 +244,7 @@ def _get_base_base(x):
 AllResources = namedtuple("AllResources", "basename2filename base2basename2filename")
 
 
-@dtu.memoize_simple
+@functools.lru_cache(maxsize=1)
 def get_all_resources():
     patterns = [
         "*.bag",
@@ -1,6 +1,86 @@
+import threading
+
 import cv2
 import numpy as np
-from scipy import fftpack
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is not available on every platform, run the kernels as plain Python
+    def njit(*_, **__):
+        return lambda func: func
+
+
+# Maximum distance (Hz) between the measured and a protocol frequency to identify a signal
+FREQUENCY_TOLERANCE = 0.35
+# Relative difference under which the powers of two spectrum bins are considered equal
+POWER_TIE_TOLERANCE = 1e-5
+
+
+@njit(fastmath=True, nogil=True, cache=True)
+def _goertzel(signal, coeffs):
+    """
+    Computes the power of the DFT of a signal at the given bins with the Goertzel algorithm.
+
+    Args:
+        signal (:obj:`numpy array`): signal of N_images samples
+        coeffs (:obj:`numpy array`): float64 Goertzel coefficients 2*cos(2*pi*k/N_images) of the bins k
+
+    Returns:
+        power (:obj:`numpy array`): float32 squared magnitude of the DFT at each bin
+    """
+    num_img = signal.shape[0]
+    power = np.empty(coeffs.shape[0], dtype=np.float32)
+    for j in range(coeffs.shape[0]):
+        coeff = coeffs[j]
+        s_prev = 0.0
+        s_prev2 = 0.0
+        for n in range(num_img):
+            s = signal[n] + coeff * s_prev - s_prev2
+            s_prev2 = s_prev
+            s_prev = s
+        power[j] = s_prev * s_prev + s_prev2 * s_prev2 - coeff * s_prev * s_prev2
+    return power
+
+
+@njit(fastmath=True, nogil=True, cache=True)
+def _interpret_signal_kernel(signals, coeffs, freqs, protocol_freqs):
+    """
+    Computes the dominant frequency of a stack of signals and matches it against the LED protocol.
+
+    Args:
+        signals (:obj:`numpy array`): uint8 array of on/off signals in form N_signalsxN_images
+        coeffs (:obj:`numpy array`): float64 Goertzel coefficients of the bins of the one-sided spectrum
+        freqs (:obj:`numpy array`): float32 frequencies of the bins of the one-sided spectrum
+        protocol_freqs (:obj:`numpy array`): float32 frequencies of the LED protocol
+
+    Returns:
+        peaks (:obj:`numpy array`): int32 index in `freqs` of the dominant frequency of each signal. If
+        several bins have the same power (up to rounding errors), the lowest frequency is kept
+        matches (:obj:`numpy array`): int32 index in `protocol_freqs` of the identified frequency of each
+        signal, -1 if none matches
+    """
+    num_signals, num_img = signals.shape
+    peaks = np.zeros(num_signals, dtype=np.int32)
+    matches = np.full(num_signals, -1, dtype=np.int32)
+
+    for i in range(num_signals):
+        # Power spectrum of the zero-mean signal scaled by N_images, which keeps it integer
+        signal = signals[i].astype(np.int32)
+        power = _goertzel(signal * num_img - signal.sum(), coeffs)
+        # Keep the lowest frequency among the bins tied for the maximum power
+        min_power = power.max() * (1.0 - POWER_TIE_TOLERANCE)
+        peak = 0
+        while power[peak] < min_power:
+            peak += 1
+        peaks[i] = peak
+
+        for j in range(protocol_freqs.shape[0]):
+            if abs(freqs[peaks[i]] - protocol_freqs[j]) < FREQUENCY_TOLERANCE:
+                matches[i] = j
+                break
+
+    return peaks, matches
 
 
 class LEDDetector:
@@ -15,11 +95,25 @@ class LEDDetector:
     def __init__(self, parameters, logger):
         self.log = logger
         self.parameters = parameters
-        # create the detector object
-        self.detector = {}
+        # parameters of the detector objects
+        self.detector_params = {}
+        # detector objects, one set per thread as they cannot be shared between threads
+        self._local = threading.local()
+        # frequencies of the LED protocol, as a list and as an array for the kernel
+        self._protocol_freqs = ([], np.zeros(0, dtype=np.float32))
+        # spectrum bins for each number of images and sample time
+        self._spectrum_bins = {}
 
         self.update_parameters(self.parameters)
 
+        # Compile the frequency kernel now instead of during the first detection
+        _interpret_signal_kernel(
+            np.zeros((1, 2), dtype=np.uint8),
+            np.zeros(2),
+            np.zeros(2, dtype=np.float32),
+            np.zeros(1, dtype=np.float32),
+        )
+
     def update_parameters(self, new_parameters):
         """
         Updates parameters.
@@ -36,16 +130,58 @@ class LEDDetector:
         for key, val in list(self.parameters["~blob_detector_tl"].items()):
             setattr(bd_param_tl, key, val)
 
-        # Create a detector with the parameters
-        self.detector["car"] = cv2.SimpleBlobDetector_create(bd_param_db)
-        self.detector["tl"] = cv2.SimpleBlobDetector_create(bd_param_tl)
+        # Store the parameters, the detectors are (re)created on first use by each thread
+        self.detector_params = {"car": bd_param_db, "tl": bd_param_tl}
+        self._local = threading.local()
+
+        # Frequencies to identify, as a list to look them up and as an array for the kernel. Both are
+        # replaced in a single assignment as they are read from the processing threads.
+        protocol_freqs = list(self.parameters["~LED_protocol"]["frequencies"].values())
+        self._protocol_freqs = (protocol_freqs, np.array(protocol_freqs, dtype=np.float32))
+        self._spectrum_bins = {}
+
+    def get_spectrum_bins(self, num_img, t_s):
+        """
+        Returns the bins of the one-sided spectrum of a signal, computed once for each number of images
+        and sample time.
+
+        Args:
+            num_img (:obj:`int`): The number of images in the detection.
+            t_s (:obj:`float`): The sample time.
+
+        Returns:
+            coeffs (:obj:`numpy array`): float64 Goertzel coefficients of the bins
+            freqs (:obj:`numpy array`): float32 frequencies of the bins
+        """
+        key = (num_img, t_s)
+        if key not in self._spectrum_bins:
+            k_bins = np.arange(num_img // 2 + 1)
+            coeffs = 2.0 * np.cos(2.0 * np.pi * k_bins / num_img)
+            freqs = k_bins.astype(np.float32) / (num_img * t_s)
+            self._spectrum_bins[key] = (coeffs, freqs)
+        return self._spectrum_bins[key]
+
+    def get_detector(self, target):
+        """
+        Returns the blob detector of the calling thread for the given target.
+
+        Args:
+            target (:obj:`str`): the target type for the detection (traffic light or duckiebot)
+
+        Returns:
+            detector (:obj:`cv2.SimpleBlobDetector`): the blob detector
+        """
+        detectors = self._local.__dict__.setdefault("detectors", {})
+        if target not in detectors:
+            detectors[target] = cv2.SimpleBlobDetector_create(self.detector_params[target])
+        return detectors[target]
 
     def find_blobs(self, images, target):
         """
         Updates parameters.
 
         Args:
-            images (:obj:`numpy array`): an array of images in form of HxWxN_images
+            images (:obj:`numpy array`): an array of images in form of N_imagesxHxW
             target (:obj:`str`): the target type for the detection (traffic light or duckiebot)
 
         Returns:
@@ -55,11 +191,12 @@ class LEDDetector:
 
         blobs = []
         frames = []
+        detector = self.get_detector(target)
 
         # Iterate over the sequence of images
-        for t, img in enumerate(np.rollaxis(images, 2)):
+        for t, img in enumerate(images):
             frame = []
-            keypoints = self.detector[target].detect(img)
+            keypoints = detector.detect(img)
 
             for kp in keypoints:
                 kp_coords = np.asarray(kp.pt)
@@ -67,7 +204,9 @@ class LEDDetector:
 
                 if len(blobs) == 0:
                     # If no blobs saved, then save the first LED detected
-                    blobs.append({"p": kp_coords, "N": 1, "Signal": np.zeros(images.shape[2])})
+                    blobs.append(
+                        {"p": kp_coords, "N": 1, "Signal": np.zeros(images.shape[0], dtype=np.uint8)}
+                    )
                     blobs[-1]["Signal"][t] = 1
 
                 else:
@@ -81,7 +220,9 @@ class LEDDetector:
                             blobs[idx_closest]["Signal"][t] = 1
                     else:
                         # Its a new one
-                        blobs.append({"p": kp_coords, "N": 1, "Signal": np.zeros(images.shape[2])})
+                        blobs.append(
+                            {"p": kp_coords, "N": 1, "Signal": np.zeros(images.shape[0], dtype=np.uint8)}
+                        )
                         blobs[-1]["Signal"][t] = 1
 
             frames.append(frame)
@@ -111,16 +252,21 @@ class LEDDetector:
         frequency: 7.8
         """
 
+        # Only the first blob decides the signal, do not examine the others
+        blobs = blobs[:1]
+        detected, freqs_identified, fft_peak_freqs = self.examine_blobs(blobs, t_s, num_img)
+
         # Semantically decide if blobs represent a known signal
-        for blob in blobs:
-            # Detection
-            detected, freq_identified, fft_peak_freq = self.examine_blob(blob, t_s, num_img)
+        for i, blob in enumerate(blobs):
+            if self.parameters["~verbose"] == 2:
+                appearance_percentage = (1.0 * blob["N"]) / (1.0 * num_img)
+                self.log(f"Appearance perceived. = {appearance_percentage}, frequency = {fft_peak_freqs[i]}")
 
             # Take decision
             detected_signal = None
-            if detected:
+            if detected[i]:
                 for signal_name, signal_value in list(self.parameters["~LED_protocol"]["signals"].items()):
-                    if signal_value["frequency"] == freq_identified:
+                    if signal_value["frequency"] == freqs_identified[i]:
                         detected_signal = signal_name
                         break
 
@@ -128,8 +274,8 @@ class LEDDetector:
                     "\n-------------------\n"
                     + f"num_img = {num_img} \n"
                     + f"t_samp = {t_s} \n"
-                    + f"fft_peak_freq = {fft_peak_freq} \n"
-                    + f"freq_identified = {freq_identified} \n"
+                    + f"fft_peak_freq = {fft_peak_freqs[i]} \n"
+                    + f"freq_identified = {freqs_identified[i]} \n"
                     + f"signal_name = {detected_signal} \n"
                     + "-------------------"
                 )
@@ -137,42 +283,37 @@ class LEDDetector:
 
             return detected_signal
 
-    def examine_blob(self, blob, t_s, num_img):
+    def examine_blobs(self, blobs, t_s, num_img):
         """
-        Detects if a blob is blinking at specific frequencies.
+        Detects which blobs are blinking at specific frequencies.
 
         Args:
-            blob (:obj:`list`): A detected blob.
+            blobs (:obj:`list`): The detected blobs.
             t_s (:obj:`float`): The sample time.
             num_img (:obj:`int`): The number of images in the detection.
 
         Returns:
-            detected (:obj:`bool`): Whether a signal was detected.
-            freq_identified (:obj:`float`): The identified frequency (must be in the protocol)
-            fft_peak_freq (:obj:`float`): The computed signal frequency using the FFT.
+            detected (:obj:`numpy array`): Whether a signal was detected, for each blob.
+            freqs_identified (:obj:`list`): The identified frequency (must be in the protocol) of each blob,
+            None if not detected.
+            fft_peak_freqs (:obj:`numpy array`): The computed signal frequency of each blob.
         """
-        # Percentage of appearance
-        appearance_percentage = (1.0 * blob["N"]) / (1.0 * num_img)
+        # Stack the signals of the blobs
+        signals = np.empty((len(blobs), num_img), dtype=np.uint8)
+        for i, blob in enumerate(blobs):
+            signals[i] = blob["Signal"]
 
-        # Frequency estimation based on FFT
-        signal_f = fftpack.fft(blob["Signal"] - np.mean(blob["Signal"]))
-        y_f = 2.0 / num_img * np.abs(signal_f[: num_img // 2 + 1])
-        fft_peak_freq = 1.0 * np.argmax(y_f) / (num_img * t_s)
+        # Frequency estimation based on the spectrum of the signals
+        coeffs, freqs = self.get_spectrum_bins(num_img, t_s)
+        protocol_freqs, protocol_freqs_array = self._protocol_freqs
+        peaks, matches = _interpret_signal_kernel(signals, coeffs, freqs, protocol_freqs_array)
+        fft_peak_freqs = 1.0 * peaks / (num_img * t_s)
 
-        if self.parameters["~verbose"] == 2:
-            self.log(f"Appearance perceived. = {appearance_percentage}, frequency = {fft_peak_freq}")
-        freq_identified = None
         # Take decision
-        detected = False
-        freq_to_identify = list(self.parameters["~LED_protocol"]["frequencies"].values())
-        for freq in freq_to_identify:
-            if abs(fft_peak_freq - freq) < 0.35:
-                # Decision
-                detected = True
-                freq_identified = freq
-                break
+        detected = matches >= 0
+        freqs_identified = [protocol_freqs[m] if m >= 0 else None for m in matches]
 
-        return detected, freq_identified, fft_peak_freq
+        return detected, freqs_identified, fft_peak_freqs
 
     @staticmethod
     def get_keypoints(blobs, radius):
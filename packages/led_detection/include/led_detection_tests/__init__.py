@@ -0,0 +1 @@
+from . import signal_frequency
@@ -0,0 +1,68 @@
+import numpy as np
+
+import duckietown_code_utils as dtu
+from led_detection.LED_detector import LEDDetector
+
+# Frequencies of the LED protocol (duckietown_protocols/LED_protocol.yaml)
+PROTOCOL_FREQUENCIES = {"f1": 1.9, "f2": 4, "f3": 5.7, "f4": 7.8, "f5": 10.6}
+
+# Default capture: 0.5 s at 30 fps
+NUM_IMG = 15
+T_S = 0.5 / NUM_IMG
+
+
+def get_detector():
+    parameters = {
+        "~verbose": 0,
+        "~blob_detector_db": {},
+        "~blob_detector_tl": {},
+        "~LED_protocol": {"frequencies": PROTOCOL_FREQUENCIES, "signals": {}},
+    }
+    return LEDDetector(parameters, dtu.logger.info)
+
+
+def identify(signal):
+    signal = np.array(signal, dtype=np.uint8)
+    blob = {"p": np.zeros(2), "N": int(signal.sum()), "Signal": signal}
+    _, freqs_identified, fft_peak_freqs = get_detector().examine_blobs([blob], T_S, NUM_IMG)
+    return freqs_identified[0], fft_peak_freqs[0]
+
+
+def blinking(frequency):
+    t = np.arange(NUM_IMG) * T_S
+    return ((t * frequency) % 1.0 < 0.5).astype(np.uint8)
+
+
+@dtu.unit_test
+def identify_protocol_frequencies():
+    for frequency in [1.9, 4, 5.7, 7.8]:
+        freq_identified, fft_peak_freq = identify(blinking(frequency))
+        assert freq_identified == frequency, (frequency, freq_identified, fft_peak_freq)
+
+
+@dtu.unit_test
+def frequency_above_resolution():
+    # 10.6 Hz peaks in the 10 Hz bin, too far from the protocol frequency to be identified
+    freq_identified, fft_peak_freq = identify(blinking(10.6))
+    assert np.isclose(fft_peak_freq, 10.0), fft_peak_freq
+    assert freq_identified is None, freq_identified
+
+
+@dtu.unit_test
+def constant_signal():
+    for value in [0, 1]:
+        freq_identified, fft_peak_freq = identify([value] * NUM_IMG)
+        assert np.isclose(fft_peak_freq, 0.0), fft_peak_freq
+        assert freq_identified is None, freq_identified
+
+
+@dtu.unit_test
+def tie_keeps_lowest_frequency():
+    # The 6 Hz and 12 Hz bins have the same power, the lowest frequency is kept
+    freq_identified, fft_peak_freq = identify([1, 1, 1, 0, 1] * 3)
+    assert np.isclose(fft_peak_freq, 6.0), fft_peak_freq
+    assert freq_identified == 5.7, freq_identified
+
+
+if __name__ == "__main__":
+    dtu.run_tests_for_this_module()
@@ -5,6 +5,7 @@ from catkin_pkg.python_setup import generate_distutils_setup
 setup_args = generate_distutils_setup(
     packages=[
         "led_detection",
+        "led_detection_tests",
     ],
     install_requires=[],
     package_dir={"": "include"},
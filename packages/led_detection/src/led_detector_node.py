@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
 import cv2
 import numpy as np
 
 import rospy
-from cv_bridge import CvBridge
+from turbojpeg import TurboJPEG
 from duckietown.dtros import DTROS, NodeType
 from duckietown_msgs.msg import SignalsDetection
-from duckietown_rosdata_utils import numpy_from_ros_compressed
 from led_detection.LED_detector import LEDDetector
 from sensor_msgs.msg import CompressedImage
 
@@ -15,8 +19,9 @@ from sensor_msgs.msg import CompressedImage
 class LEDDetectorNode(DTROS):
     """
     This node extracts signals from a series of images. The images are collected,
-    a blob detection is applied, then a FFT (https://en.wikipedia.org/wiki/Fast_Fourier_transform)
-    is used to extract a frequency of a blinking LED. If this matches a signal specified in the
+    a blob detection is applied, then the spectrum of the signal of each blob, computed with the Goertzel
+    algorithm (https://en.wikipedia.org/wiki/Goertzel_algorithm), is used to extract a frequency of a
+    blinking LED. If this matches a signal specified in the
     LED protocol, the signal is published.
 
     Args:
@@ -41,7 +46,7 @@ class LEDDetectorNode(DTROS):
 
         self.node_name = "LED_DETECTOR_NODE"
         # Needed to publish images
-        self.bridge = CvBridge()
+        self._jpeg = TurboJPEG()
 
         # Add the node parameters to the parameters dictionary
         self.params = dict()
@@ -56,18 +61,38 @@ class LEDDetectorNode(DTROS):
         self.params["~cell_size"] = rospy.get_param("~cell_size", None)
         self.params["~LED_protocol"] = rospy.get_param("~LED_protocol", None)
 
+        # Parameters used on every frame, refreshed when the parameters change
+        self._capture_time = None
+        self._verbose = None
+        self._dtol = None
+        self.cache_parameters()
+
         # Initialize detector
         self.detector = LEDDetector(self.params, self.log)
+        # Workers to run the detection on the three crops concurrently
+        self._pool = ThreadPoolExecutor(max_workers=3)
 
         # self.updateParameters()  TODO: This needs be replaced by the new DTROS callback when it is
         #  implemented
 
         self.first_timestamp = 0
-        self.capture_finished = True
         self.t_init = None
         self.trigger = True
-        self.node_state = 0
-        self.data = []
+        # Double buffer, images are captured into one buffer while the other one is processed. The buffers
+        # are allocated on the first frame once the image size is known
+        self._bufs = [None, None]
+        self._stamps = [None, None]
+        self._write_idx = 0
+        self.n_frames = 0
+        self._image_shape = None
+        # Buffers that can be captured into next, and captured buffers waiting to be processed
+        self._free_bufs = queue.Queue()
+        self._free_bufs.put(1)
+        self._ready_bufs = queue.Queue(maxsize=1)
+        # Crop windows of the images, computed once the image size is known
+        self._crop_slices = None
+        # Expected time between two frames, used to size the capture buffers
+        self.expected_dt = 1.0 / 30.0
         self.misdetection = 0  # use to store how many times traffic light signal happend elsewhere to
         # check calibration.
 
@@ -90,117 +115,190 @@ class LEDDetectorNode(DTROS):
         )
         self.pub_image_TL = rospy.Publisher("~image_detection_TL/compressed", CompressedImage, queue_size=1)
 
+        # Process the captured images in the background
+        self._processor = Thread(target=self.process_loop, daemon=True)
+        self._processor.start()
+
         # Subscribers
-        self.sub_cam = rospy.Subscriber("~image/compressed", CompressedImage, self.camera_callback)
+        self.sub_cam = rospy.Subscriber(
+            "~image/compressed", CompressedImage, self.camera_callback, queue_size=1, buff_size="10MB"
+        )
 
         # Log info
         self.log("Initialized!")
 
+    def on_shutdown(self):
+        self.loginfo("Shutting down workers pool")
+        self._pool.shutdown()
+
     def camera_callback(self, msg):
         """
-        Callback that collects images and starts the detection. It unregister the subscriber while processing
-        the images. Once finished, it restarts it.
+        Callback that collects images. Once enough images are collected, they are handed over to the
+        processing thread and the capture of the next series starts immediately.
 
         Args:
             msg (:obj:`sensor_msgs.msg.CompressedImage`): Input image.
         """
         float_time = msg.header.stamp.to_sec()
 
+        # Capture finished, start processing
+        if not self.trigger and float_time - self.first_timestamp >= self._capture_time:
+            if self._verbose == 2:
+                self.log(f"Relative Time {float_time - self.first_timestamp}, processing")
+            self.hand_over()
+            self.trigger = True
+
         if self.trigger:
             self.trigger = False
-            self.data = []
-            self.capture_finished = False
+            self.n_frames = 0
             # Start capturing images
-            self.first_timestamp = msg.header.stamp.to_sec()
+            self.first_timestamp = float_time
             self.t_init = rospy.Time.now().to_sec()
 
-        elif self.capture_finished:
-            self.node_state = 0
-
-        if self.first_timestamp > 0:
-            rel_time = float_time - self.first_timestamp
-
-            # Capturing
-            if rel_time < self.params["~capture_time"]:
-                self.node_state = 1
-                # Capture image
-                rgb = numpy_from_ros_compressed(msg)
-                rgb = cv2.cvtColor(rgb, cv2.COLOR_BGRA2GRAY)
-                rgb = 255 - rgb
-                self.data.append({"timestamp": float_time, "rgb": rgb[:, :]})
-
-            # Start processing
-            elif not self.capture_finished and self.first_timestamp > 0:
-                if self.params["~verbose"] == 2:
-                    self.log(f"Relative Time {rel_time}, processing")
-                self.node_state = 2
-                self.capture_finished = True
-                self.first_timestamp = 0
-
-                # IMPORTANT! Explicitly ignore messages while processing, accumulates delay otherwise!
-                self.sub_cam.unregister()
+        # Capture image
+        # Decode directly to grayscale (zero-copy view of the message data), then invert into the slot of
+        # the capture buffer
+        gray = cv2.imdecode(np.frombuffer(msg.data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if self.n_frames == 0 or self.n_frames == self._stamps[self._write_idx].shape[0]:
+            self.allocate_buffers(gray.shape)
+        cv2.bitwise_not(gray, dst=self._bufs[self._write_idx][self.n_frames])
+        self._stamps[self._write_idx][self.n_frames] = float_time
+        self.n_frames += 1
+
+    def hand_over(self):
+        """
+        Hands the buffer that was just filled over to the processing thread and switches capture to the
+        other buffer. If the previous images are still being processed, the new ones are dropped.
+        """
+        try:
+            next_idx = self._free_bufs.get_nowait()
+        except queue.Empty:
+            if self._verbose == 2:
+                self.log("Still processing the previous images, dropping the new ones")
+            return
+        self._ready_bufs.put((self._write_idx, self.n_frames, self.t_init))
+        self._write_idx = next_idx
+
+    def process_loop(self):
+        """
+        Processes the captured images handed over by `camera_callback` until the node is shut down.
+        """
+        while not self.is_shutdown:
+            try:
+                idx, num_img, t_init = self._ready_bufs.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                self.process_and_publish(self._bufs[idx][:num_img], t_init)
+            except Exception:
+                # Keep processing the next images
+                self.logerr(f"Error while processing the images:\n{traceback.format_exc()}")
+            finally:
+                self._free_bufs.put(idx)
+
+    def allocate_buffers(self, shape):
+        """
+        Makes sure the current capture buffer can hold the next frame. The buffer is (re)allocated at the
+        beginning of a capture window if the image size or the capture time changed, and grown if the
+        camera delivers more frames than expected. Only needs to be called at the beginning of a capture
+        window or when the buffer is full.
 
-                # Process image and publish results
-                self.process_and_publish()
+        Args:
+            shape (:obj:`tuple`): Shape (H, W) of the grayscale image to store.
+        """
+        images = self._bufs[self._write_idx]
+        if self.n_frames == 0:
+            n_max = int(self._capture_time / self.expected_dt) + 8
+            if images is None or images.shape[1:] != shape or images.shape[0] < n_max:
+                self._bufs[self._write_idx] = np.empty((n_max,) + shape, dtype=np.uint8)
+                self._stamps[self._write_idx] = np.empty(n_max, dtype=np.float64)
+            if shape != self._image_shape:
+                self._image_shape = shape
+                self.update_crop_slices()
+        elif self.n_frames == images.shape[0]:
+            # More frames than expected, double the capacity
+            stamps = self._stamps[self._write_idx]
+            self._bufs[self._write_idx] = np.concatenate((images, np.empty_like(images)))
+            self._stamps[self._write_idx] = np.concatenate((stamps, np.empty_like(stamps)))
+
+    def update_crop_slices(self):
+        """
+        Computes the crop windows of the images from the crop parameters. Does nothing until the first
+        image has been received.
+        """
+        if self._image_shape is None:
+            return
+        crop_params = self.params["~crop_params"]
+        shape = self._image_shape
+        crop_slices = {
+            "right": self.crop_slices(shape, crop_params["cropNormalizedRight"]),
+            "front": self.crop_slices(shape, crop_params["cropNormalizedFront"]),
+            "tl": self.crop_slices(shape, crop_params["cropNormalizedTL"]),
+        }
+        # Replace all the windows at once, they are read by the processing thread
+        self._crop_slices = crop_slices
 
     @staticmethod
-    def crop_image(images, crop_norm):
+    def crop_slices(shape, crop_norm):
         """
-        Crops an array of images according to `crop_norm`.
+        Computes the slices that crop an array of images in form N_imagesxHxW according to `crop_norm`.
 
         Args:
-            images (:obj:`numpy array`): Images in form HxWxN_images
+            shape (:obj:`tuple`): Shape (H, W) of the images.
             crop_norm (:obj:`list`): List of lists containing the crop limits.
+
+        Returns:
+            slices (:obj:`tuple`): Slices to apply to an array of images.
         """
         # Get size
-        height, width, _ = images.shape
+        height, width = shape
         # Compute indices
         h_start = int(np.floor(height * crop_norm[0][0]))
         h_end = int(np.ceil(height * crop_norm[0][1]))
         w_start = int(np.floor(width * crop_norm[1][0]))
         w_end = int(np.ceil(width * crop_norm[1][1]))
-        # Crop image
-        image_cropped = images[h_start:h_end, w_start:w_end, :]
-        # Return cropped image
-        return image_cropped
+        # Return crop slices
+        return slice(None), slice(h_start, h_end), slice(w_start, w_end)
 
-    def process_and_publish(self):
+    def process_and_publish(self, images, t_init):
         """
         Processes the images (detection and interpretation) using an instantiated `LED_detector` object.
+
+        Args:
+            images (:obj:`numpy array`): Images in form N_imagesxHxW
+            t_init (:obj:`float`): Time at which the capture of the images started.
         """
         # Initial time
         tic = rospy.Time.now().to_sec()
 
-        # Get dimensions
-        h, w = self.data[0]["rgb"].shape
-        num_img = len(self.data)
+        verbose = self._verbose
 
-        # Save images in numpy arrays
-        images = np.zeros((h, w, num_img), dtype=np.uint8)
-        timestamps = np.zeros(num_img)
-        for i, v in enumerate(self.data):
-            timestamps[i] = v["timestamp"]
-            images[:, :, i] = v["rgb"]
+        num_img, h, w = images.shape
+        crop_slices = self._crop_slices
 
         # Crop images
-        img_right = self.crop_image(images, self.params["~crop_params"]["cropNormalizedRight"])
-        img_front = self.crop_image(images, self.params["~crop_params"]["cropNormalizedFront"])
-        img_tl = self.crop_image(images, self.params["~crop_params"]["cropNormalizedTL"])
+        img_right = images[crop_slices["right"]]
+        img_front = images[crop_slices["front"]]
+        img_tl = images[crop_slices["tl"]]
 
         # Print on screen
-        if self.params["~verbose"] == 2:
+        if verbose == 2:
             self.log(f"Analyzing {num_img} images of size {w} X {h}")
 
+        # Get blobs in the crops concurrently, OpenCV releases the GIL while detecting
+        future_right = self._pool.submit(self.detector.find_blobs, img_right, "car")
+        future_front = self._pool.submit(self.detector.find_blobs, img_front, "car")
+        future_tl = self._pool.submit(self.detector.find_blobs, img_tl, "tl")
         # Get blobs right
-        blobs_right, frame_right = self.detector.find_blobs(img_right, "car")
+        blobs_right, frame_right = future_right.result()
         # Get blobs front
-        blobs_front, frame_front = self.detector.find_blobs(img_front, "car")
-        # Get blobs right
-        blobs_tl, frame_tl = self.detector.find_blobs(img_tl, "tl")
+        blobs_front, frame_front = future_front.result()
+        # Get blobs traffic light
+        blobs_tl, frame_tl = future_tl.result()
 
-        radius = self.params["~DTOL"] / 2.0
+        radius = self._dtol / 2.0
 
-        if self.params["~verbose"] > 0:
+        if verbose > 0:
             # Extract blobs for visualization
             keypoint_blob_right = self.detector.get_keypoints(blobs_right, radius)
             keypoint_blob_front = self.detector.get_keypoints(blobs_front, radius)
@@ -208,21 +306,21 @@ class LEDDetectorNode(DTROS):
 
             # Images
             img_pub_right = cv2.drawKeypoints(
-                img_right[:, :, -1],
+                img_right[-1],
                 keypoint_blob_right,
                 np.array([]),
                 (0, 0, 255),
                 cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS,
             )
             img_pub_front = cv2.drawKeypoints(
-                img_front[:, :, -1],
+                img_front[-1],
                 keypoint_blob_front,
                 np.array([]),
                 (0, 0, 255),
                 cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS,
             )
             img_pub_tl = cv2.drawKeypoints(
-                img_tl[:, :, -1],
+                img_tl[-1],
                 keypoint_blob_tl,
                 np.array([]),
                 (0, 0, 255),
@@ -239,7 +337,7 @@ class LEDDetectorNode(DTROS):
         self.traffic_light = None
 
         # Sampling time
-        t_s = (1.0 * self.params["~capture_time"]) / (1.0 * num_img)
+        t_s = (1.0 * self._capture_time) / (1.0 * num_img)
 
         # Decide whether LED or not
         self.right = self.detector.interpret_signal(blobs_right, t_s, num_img)
@@ -285,22 +383,18 @@ class LEDDetectorNode(DTROS):
 
         # Final time
         processing_time = rospy.Time.now().to_sec() - tic
-        total_time = rospy.Time.now().to_sec() - self.t_init
+        total_time = rospy.Time.now().to_sec() - t_init
 
         # Publish results
         self.publish(img_pub_right, img_pub_front, img_pub_tl)
 
         # Print performance
-        if self.params["~verbose"] == 2:
+        if verbose == 2:
             self.log(
                 f"[{self.node_name}] Detection completed. Processing time: {processing_time:.2f} s. Total "
                 f"time:  {total_time:.2f} s"
             )
 
-        # Keep going
-        self.trigger = True
-        self.sub_cam = rospy.Subscriber("~image/compressed", CompressedImage, self.camera_callback)
-
     def publish(self, img_right, img_front, img_tl):
         """
         Publishes the results of the detection, in case of high verbosity, it publishes debug images of the
@@ -312,15 +406,21 @@ class LEDDetectorNode(DTROS):
             img_tl (:obj:`numpy array`): Debug image
         """
         #  Publish image with circles if verbose is > 0
-        if self.params["~verbose"] > 0:
-            img_right_circle_msg = self.bridge.cv2_to_compressed_imgmsg(img_right)  # , encoding="bgr8")
-            img_front_circle_msg = self.bridge.cv2_to_compressed_imgmsg(img_front)  # , encoding="bgr8")
-            img_tl_circle_msg = self.bridge.cv2_to_compressed_imgmsg(img_tl)  # , encoding="bgr8")
+        if self._verbose > 0:
+            # Encode concurrently the images somebody is listening to, libjpeg-turbo releases the GIL
+            futures = [
+                (pub, self._pool.submit(self.compress_image, img))
+                for pub, img in [
+                    (self.pub_image_right, img_right),
+                    (self.pub_image_front, img_front),
+                    (self.pub_image_TL, img_tl),
+                ]
+                if pub.anybody_listening()
+            ]
 
             # Publish image
-            self.pub_image_right.publish(img_right_circle_msg)
-            self.pub_image_front.publish(img_front_circle_msg)
-            self.pub_image_TL.publish(img_tl_circle_msg)
+            for pub, future in futures:
+                pub.publish(future.result())
 
         # Log results to the terminal
         rospy.loginfo(
@@ -337,9 +437,32 @@ class LEDDetectorNode(DTROS):
         )
         self.pub_detections.publish(detections_msg)
 
+    def compress_image(self, img):
+        """
+        Compresses a debug image to JPEG.
+
+        Args:
+            img (:obj:`numpy array`): BGR image
+
+        Returns:
+            msg (:obj:`sensor_msgs.msg.CompressedImage`): The compressed image.
+        """
+        msg = CompressedImage()
+        msg.format = "jpeg"
+        msg.data = self._jpeg.encode(img)
+        return msg
+
+    def cache_parameters(self):
+        """Copies the parameters used on every frame to attributes, to avoid dictionary lookups."""
+        self._capture_time = self.params["~capture_time"]
+        self._verbose = self.params["~verbose"]
+        self._dtol = self.params["~DTOL"]
+
     def cbParametersChanged(self):
         """Updates parameters."""
         self.detector.update_parameters(self.params)
+        self.cache_parameters()
+        self.update_crop_slices()
 
 
 if __name__ == "__main__":